@@ -0,0 +1,238 @@
+# A minimal MessagePack encoder and decoder with no third party dependencies.
+# Supports nil, bool, int, float, str, bin, array and map, which covers everything produced by reprJSON.
+# See https://github.com/msgpack/msgpack/blob/master/spec.md
+
+from struct import Struct, error as StructError
+from typing import Any, Callable, Tuple
+
+_u8, _u16, _u32, _u64 = Struct('>B'), Struct('>H'), Struct('>I'), Struct('>Q')
+_i8, _i16, _i32, _i64 = Struct('>b'), Struct('>h'), Struct('>i'), Struct('>q')
+_f32, _f64 = Struct('>f'), Struct('>d')
+
+class PackException(Exception):
+    pass
+
+MAX_DEPTH = 256
+"""The deepest nesting of arrays and maps unpackb accepts, well inside Python's recursion limit."""
+
+def packb(obj: Any, default: Callable[[Any], Any] = None) -> bytes:
+    """Encodes obj as MessagePack. Objects of unsupported types are passed to default,
+    which must return a supported value, in the same way as json.dumps."""
+    buffer = bytearray()
+    _pack(obj, buffer, default)
+    return bytes(buffer)
+
+def _pack(obj: Any, buffer: bytearray, default: Callable) -> None:
+    t = type(obj)
+    if t is str:
+        data = obj.encode()
+        n = len(data)
+        if n < 32:
+            buffer.append(0xa0 | n)
+        elif n < 0x100:
+            buffer.append(0xd9)
+            buffer.append(n)
+        elif n < 0x10000:
+            buffer.append(0xda)
+            buffer += _u16.pack(n)
+        else:
+            buffer.append(0xdb)
+            buffer += _u32.pack(n)
+        buffer += data
+    elif obj is None:
+        buffer.append(0xc0)
+    elif t is bool:
+        buffer.append(0xc3 if obj else 0xc2)
+    elif t is int:
+        _pack_int(obj, buffer)
+    elif t is float:
+        buffer.append(0xcb)
+        buffer += _f64.pack(obj)
+    elif t is dict:
+        n = len(obj)
+        if n < 16:
+            buffer.append(0x80 | n)
+        elif n < 0x10000:
+            buffer.append(0xde)
+            buffer += _u16.pack(n)
+        else:
+            buffer.append(0xdf)
+            buffer += _u32.pack(n)
+        for key, value in obj.items():
+            packed = _keys.get(key) if type(key) is str else None
+            if packed is None:
+                packed = _pack_key(key, default)
+            buffer += packed
+            _pack(value, buffer, default)
+    elif t is list or t is tuple:
+        n = len(obj)
+        if n < 16:
+            buffer.append(0x90 | n)
+        elif n < 0x10000:
+            buffer.append(0xdc)
+            buffer += _u16.pack(n)
+        else:
+            buffer.append(0xdd)
+            buffer += _u32.pack(n)
+        for value in obj:
+            _pack(value, buffer, default)
+    elif t is bytes or t is bytearray or t is memoryview:
+        n = len(obj)
+        if n < 0x100:
+            buffer.append(0xc4)
+            buffer.append(n)
+        elif n < 0x10000:
+            buffer.append(0xc5)
+            buffer += _u16.pack(n)
+        else:
+            buffer.append(0xc6)
+            buffer += _u32.pack(n)
+        buffer += obj
+    elif isinstance(obj, str):
+        # Subclasses such as str enums are packed as their base type.
+        _pack(str.__str__(obj), buffer, default)
+    elif isinstance(obj, int):
+        _pack(int(obj), buffer, default)
+    elif isinstance(obj, float):
+        _pack(float(obj), buffer, default)
+    elif isinstance(obj, dict):
+        _pack(dict(obj), buffer, default)
+    elif isinstance(obj, (list, tuple)):
+        _pack(list(obj), buffer, default)
+    elif default is not None:
+        _pack(default(obj), buffer, default)
+    else:
+        raise PackException(f'Object of type {t.__name__} is not MessagePack serializable')
+
+_keys = {}
+
+def _pack_key(key: Any, default: Callable) -> bytes:
+    """Packs a map key, remembering short string keys since the same property names recur in every entity."""
+    buffer = bytearray()
+    _pack(key, buffer, default)
+    packed = bytes(buffer)
+    if type(key) is str and len(key) < 64 and len(_keys) < 4096:
+        _keys[key] = packed
+    return packed
+
+def _pack_int(n: int, buffer: bytearray) -> None:
+    if 0 <= n < 0x80:
+        buffer.append(n)
+    elif -32 <= n < 0:
+        buffer.append(n & 0xff)
+    elif n >= 0:
+        if n < 0x100:
+            buffer.append(0xcc)
+            buffer.append(n)
+        elif n < 0x10000:
+            buffer.append(0xcd)
+            buffer += _u16.pack(n)
+        elif n < 0x100000000:
+            buffer.append(0xce)
+            buffer += _u32.pack(n)
+        elif n < 0x10000000000000000:
+            buffer.append(0xcf)
+            buffer += _u64.pack(n)
+        else:
+            raise PackException(f'Integer {n} is too large for MessagePack')
+    else:
+        if n >= -0x80:
+            buffer.append(0xd0)
+            buffer += _i8.pack(n)
+        elif n >= -0x8000:
+            buffer.append(0xd1)
+            buffer += _i16.pack(n)
+        elif n >= -0x80000000:
+            buffer.append(0xd2)
+            buffer += _i32.pack(n)
+        elif n >= -0x8000000000000000:
+            buffer.append(0xd3)
+            buffer += _i64.pack(n)
+        else:
+            raise PackException(f'Integer {n} is too small for MessagePack')
+
+def unpackb(data: bytes) -> Any:
+    """Decodes a single MessagePack value, raising PackException on malformed or trailing data."""
+    data = memoryview(data)
+    try:
+        obj, offset = _unpack(data, 0, 0)
+    except (IndexError, ValueError, StructError) as ex:
+        raise PackException(f'Malformed MessagePack data: {ex}') from ex
+    if offset != len(data):
+        raise PackException(f'{len(data) - offset} bytes of trailing data')
+    return obj
+
+def _unpack(data: memoryview, offset: int, depth: int) -> Tuple[Any, int]:
+    b = data[offset]
+    offset += 1
+    if b <= 0x7f:
+        return b, offset
+    if b >= 0xe0:
+        return b - 0x100, offset
+    if 0xa0 <= b <= 0xbf:
+        n = b & 0x1f
+        return _read_str(data, offset, n, depth)
+    if 0x80 <= b <= 0x8f:
+        return _read_map(data, offset, b & 0x0f, depth)
+    if 0x90 <= b <= 0x9f:
+        return _read_array(data, offset, b & 0x0f, depth)
+    if b == 0xc0:
+        return None, offset
+    if b == 0xc2:
+        return False, offset
+    if b == 0xc3:
+        return True, offset
+    if b in _FIXED:
+        struct = _FIXED[b]
+        return struct.unpack_from(data, offset)[0], offset + struct.size
+    if b in _SIZED:
+        size, reader = _SIZED[b]
+        n = size.unpack_from(data, offset)[0]
+        return reader(data, offset + size.size, n, depth)
+    raise PackException(f'Unsupported MessagePack type byte 0x{b:02x}')
+
+def _read_str(data: memoryview, offset: int, n: int, depth: int) -> Tuple[str, int]:
+    end = offset + n
+    if end > len(data):
+        raise PackException('String runs past the end of the data')
+    return str(data[offset:end], 'utf-8'), end
+
+def _read_bin(data: memoryview, offset: int, n: int, depth: int) -> Tuple[bytes, int]:
+    end = offset + n
+    if end > len(data):
+        raise PackException('Binary runs past the end of the data')
+    return bytes(data[offset:end]), end
+
+def _check_depth(depth: int) -> int:
+    if depth >= MAX_DEPTH:
+        raise PackException(f'Arrays and maps are nested more than {MAX_DEPTH} deep')
+    return depth + 1
+
+def _read_array(data: memoryview, offset: int, n: int, depth: int) -> Tuple[list, int]:
+    depth = _check_depth(depth)
+    items = []
+    for _ in range(n):
+        item, offset = _unpack(data, offset, depth)
+        items.append(item)
+    return items, offset
+
+def _read_map(data: memoryview, offset: int, n: int, depth: int) -> Tuple[dict, int]:
+    depth = _check_depth(depth)
+    items = {}
+    for _ in range(n):
+        key, offset = _unpack(data, offset, depth)
+        items[key], offset = _unpack(data, offset, depth)
+    return items, offset
+
+_FIXED = {
+    0xca: _f32, 0xcb: _f64,
+    0xcc: _u8, 0xcd: _u16, 0xce: _u32, 0xcf: _u64,
+    0xd0: _i8, 0xd1: _i16, 0xd2: _i32, 0xd3: _i64,
+}
+
+_SIZED = {
+    0xc4: (_u8, _read_bin), 0xc5: (_u16, _read_bin), 0xc6: (_u32, _read_bin),
+    0xd9: (_u8, _read_str), 0xda: (_u16, _read_str), 0xdb: (_u32, _read_str),
+    0xdc: (_u16, _read_array), 0xdd: (_u32, _read_array),
+    0xde: (_u16, _read_map), 0xdf: (_u32, _read_map),
+}
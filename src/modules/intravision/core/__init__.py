@@ -1,3 +1,6 @@
 from .system import System, SystemUpdateEvent
 from .device import DeviceBase, DeviceSerialization, DeviceUpdateEvent
-from .service import ServiceBase, ServiceSerialization, ServiceUpdateEvent
\ No newline at end of file
+from .service import ServiceBase, ServiceSerialization, ServiceUpdateEvent
+from .scheduler import UpdateScheduler
+from .ids import entity_id
+from .loader import ConfigurationError, load_systems
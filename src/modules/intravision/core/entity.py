@@ -0,0 +1,104 @@
+import threading
+from typing import Callable, Dict, Iterable, Set
+from .event import Event
+from .serialization import ExclusionList, get_plan, pascal_to_snake, snake_to_pascal
+
+class _EntityCore:
+    """The framework owned state of a device or service, held in slots rather than the entity's __dict__
+    so the __dict__ only carries the attributes a subclass defines.
+    The exclusion list starts as the one shared by the entity's class and is copied when first changed.
+    The set of changed properties is only allocated while changes are pending,
+    and batch holds the original values of properties changed within a batch while one is open.
+    The lock guards this state and is only held briefly, while batch_lock is held by a thread for the whole
+    of its batch so other threads' property updates wait for it without holding up the update scheduler."""
+    __slots__ = ('id', 'name', 'type', 'update', 'excluded', 'last_update', 'lock', 'batch_lock', 'changes', 'full_update', 'batch')
+
+    def __init__(self, id: str, name: str, type: str, update: Event, excluded: ExclusionList):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.update = update
+        self.excluded = excluded
+        self.last_update: int = None
+        self.lock = threading.RLock()
+        self.batch_lock = threading.RLock()
+        self.changes: Set[str] = None
+        self.full_update = False
+        self.batch: Dict[str, object] = None
+
+class _ExclusionView:
+    """The exclusion list an entity exposes as json_excluded_properties.
+    Reads go to the list the entity is using, so reading never copies the list shared by its class.
+    The first change made through the view gives the entity its own copy to change."""
+    __slots__ = ('_core', '_shared')
+
+    def __init__(self, core: _EntityCore, shared: ExclusionList):
+        self._core = core
+        self._shared = shared
+
+    def _own(self) -> ExclusionList:
+        core = self._core
+        if core.excluded is self._shared:
+            core.excluded = ExclusionList(core.excluded)
+        return core.excluded
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._core.excluded
+
+    def __iter__(self):
+        return iter(self._core.excluded)
+
+    def __len__(self) -> int:
+        return len(self._core.excluded)
+
+    def __getitem__(self, index):
+        return self._core.excluded[index]
+
+    def __eq__(self, other: object) -> bool:
+        return self._core.excluded == (other._core.excluded if isinstance(other, _ExclusionView) else other)
+
+    def __repr__(self) -> str:
+        return repr(self._core.excluded)
+
+    def __iadd__(self, names: Iterable[str]) -> '_ExclusionView':
+        self._own().extend(names)
+        return self
+
+    @staticmethod
+    def unwrap(value: Iterable[str], core: _EntityCore) -> ExclusionList:
+        """Returns the list to store when json_excluded_properties is assigned value."""
+        if isinstance(value, _ExclusionView) and value._core is core:
+            return core.excluded
+        return value if isinstance(value, ExclusionList) else ExclusionList(value)
+
+def _writing(name: str) -> Callable:
+    def method(self, *args):
+        return getattr(self._own(), name)(*args)
+    method.__name__ = name
+    return method
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', '__setitem__', '__delitem__'):
+    setattr(_ExclusionView, _name, _writing(_name))
+
+_CORE_PROPERTIES = frozenset(('id', 'name', 'type'))
+"""The identifying properties of an entity, serialized but never changed by a control request."""
+
+def _control_attribute(entity: object, key: str) -> str:
+    """Returns the attribute a control request for the PascalCase key may update.
+    Raises ValueError unless the key names a property the entity serializes and is not owned by the framework."""
+    attribute = pascal_to_snake(key) if isinstance(key, str) else None
+    if (attribute is None or attribute in _CORE_PROPERTIES
+            or not (attribute in vars(entity) or isinstance(getattr(type(entity), attribute, None), property))
+            or get_plan(entity).key(attribute) != key):
+        raise ValueError(f'{entity.name} has no controllable property: {key}')
+    return attribute
+
+def _control_value(entity: object, attribute: str, value: object) -> object:
+    """Returns value as the type of the attribute a control request updates, accepting an integer for a float
+    as front ends send 1 for 1.0. Raises ValueError if the types do not match, as update_property would ignore it."""
+    expected = type(getattr(entity, attribute))
+    if expected is float and type(value) is int:
+        return float(value)
+    if type(value) is not expected:
+        raise ValueError(f'{entity.name} expects {snake_to_pascal(attribute)} to be {expected.__name__}, received {type(value).__name__}')
+    return value
@@ -1,4 +1,38 @@
-from typing import Callable
+import asyncio, inspect, logging, threading, weakref
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+_executor: ThreadPoolExecutor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the executor shared by every threaded event, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='Event')
+        return _executor
+
+class _WeakSubscriber:
+    """Calls a bound method through a weak reference so the subscription does not keep its owner alive."""
+    __slots__ = ('ref',)
+
+    def __init__(self, method: Callable, callback: Callable):
+        self.ref = weakref.WeakMethod(method, callback)
+
+    def __call__(self, sender: object, event: object):
+        method = self.ref()
+        if method is not None:
+            return method(sender, event)
+
+    def __eq__(self, other):
+        if isinstance(other, _WeakSubscriber):
+            return self.ref == other.ref
+        return self.ref() == other
+
+    def __hash__(self):
+        return hash(self.ref)
 
 class Event:
     """An event class that mimics C# events.
@@ -8,29 +42,174 @@ class Event:
     To remove subscription: my_event -= callback.
     To raise an event call: my_event.invoke(sender, event_args).
     Callback function signature must match the arguments raised.
-    Callbacks are not threaded and may block."""
+    Callbacks are not threaded and may block, unless the event is created with threaded=True,
+    in which case they run in order on the shared event executor and invoke returns immediately.
+    Coroutine functions may also subscribe. They are scheduled onto the event loop chosen when they
+    subscribed, the running loop by default, so invoke never waits for them.
+    Bound methods subscribed with weak=True do not keep their owner alive and are removed, on the next subscribe,
+    unsubscribe or invoke, once it has been collected.
+    Subscribing and unsubscribing are thread safe and never affect an invoke already in progress."""
+
+    __slots__ = ('_subscriptions', '_lock', '_last_event', 'threaded', '_queue', '_draining', '_dead')
+
+    def __init__(self, default_event: object = None, threaded: bool = False):
+        self._subscriptions: Tuple[Tuple[Callable, asyncio.AbstractEventLoop], ...] = ()
+        self._lock = threading.Lock()
+        self._last_event = default_event
+        self.threaded = threaded
+        self._queue: deque = None
+        self._draining = False
+        self._dead = False
+
+    @property
+    def subscriptions(self) -> Tuple[Callable, ...]:
+        subscriptions = (sub.ref() if isinstance(sub, _WeakSubscriber) else sub for sub, _ in self._subscriptions)
+        return tuple(sub for sub in subscriptions if sub is not None)
+
+    def subscribe(self, sub: Callable, loop: asyncio.AbstractEventLoop = None, weak: bool = False) -> None:
+        """Subscribes a callback. A coroutine function is run on loop, or on the running loop if none is given.
+        A bound method subscribed with weak is held by a weak reference and unsubscribed when its owner is collected."""
+        if weak and not inspect.ismethod(sub):
+            raise TypeError(f'Only bound methods can be subscribed weakly, received {sub!r}')
+        if inspect.iscoroutinefunction(sub):
+            if loop is None:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    raise ValueError(f'{sub} is a coroutine function and needs an event loop to run on') from None
+        else:
+            loop = None
+        if weak:
+            sub = _WeakSubscriber(sub, self._mark_dead)
+        with self._lock:
+            self._prune_locked()
+            self._subscriptions = self._subscriptions + ((sub, loop),)
+
+    def _mark_dead(self, ref: weakref.WeakMethod) -> None:
+        # Weakref callbacks can run inside garbage collection while this thread holds the lock,
+        # so the dead subscription is only flagged here and removed by the next call to _prune_locked.
+        self._dead = True
+
+    def _prune(self) -> None:
+        if self._dead:
+            with self._lock:
+                self._prune_locked()
+
+    def _prune_locked(self) -> None:
+        if self._dead:
+            self._dead = False
+            self._subscriptions = tuple((sub, loop) for sub, loop in self._subscriptions if not (isinstance(sub, _WeakSubscriber) and sub.ref() is None))
+
+    def unsubscribe(self, sub: Callable) -> None:
+        with self._lock:
+            self._prune_locked()
+            subscriptions = list(self._subscriptions)
+            for i, (subscribed, _) in enumerate(subscriptions):
+                if subscribed == sub:
+                    del subscriptions[i]
+                    break
+            else:
+                raise ValueError(f'{sub} is not subscribed')
+            self._subscriptions = tuple(subscriptions)
 
-    def __init__(self, default_event: object = None):
-        self.subscriptions: list[Callable] = []
-        self._last_event = default_event  
-    
     def __iadd__(self, sub):
-        self.subscriptions.append(sub)
+        self.subscribe(sub)
         return self
-    
+
     def __isub__(self, sub):
-        self.subscriptions.remove(sub)
+        self.unsubscribe(sub)
         return self
-    
+
     def invoke(self, sender: object, event: object):
         self._last_event = event
-        for sub in tuple(self.subscriptions):
-            sub(sender, event)
-    
+        self._prune()
+        if self.threaded:
+            self._dispatch(sender, event)
+            return
+        for sub, loop in self._subscriptions:
+            if loop is None:
+                sub(sender, event)
+            else:
+                self._schedule(sub, loop, sender, event)
+
+    async def invoke_async(self, sender: object, event: object, timeout: float = None) -> None:
+        """Runs every subscriber concurrently and waits for them all to finish.
+        Coroutines run on their own loops and plain callbacks on the shared event executor.
+        Subscriber exceptions are logged. Raises asyncio.TimeoutError, cancelling any subscribers
+        still running, if they do not all finish within timeout seconds."""
+        self._last_event = event
+        self._prune()
+        running = asyncio.get_running_loop()
+        subscriptions = self._subscriptions
+        awaitables: List[asyncio.Future] = []
+        for sub, loop in subscriptions:
+            if loop is None:
+                awaitables.append(running.run_in_executor(get_executor(), sub, sender, event))
+            elif loop is running:
+                awaitables.append(running.create_task(self._await(sub(sender, event))))
+            else:
+                awaitables.append(asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._await(sub(sender, event)), loop)))
+        results = await asyncio.wait_for(asyncio.gather(*awaitables, return_exceptions=True), timeout)
+        for (sub, _), result in zip(subscriptions, results):
+            if isinstance(result, Exception):
+                logging.error(f'Event subscriber {sub} failed', exc_info=result)
+
+    @staticmethod
+    async def _await(coroutine):
+        # A weak subscriber whose owner has been collected returns None rather than a coroutine.
+        if coroutine is not None:
+            return await coroutine
+
+    @staticmethod
+    def _schedule(sub: Callable, loop: asyncio.AbstractEventLoop, sender: object, event: object) -> None:
+        coroutine = sub(sender, event)
+        if coroutine is None:
+            return
+        try:
+            future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        except RuntimeError:
+            coroutine.close()
+            logging.debug(f'Event loop for {sub} is closed, dropping event')
+            return
+        future.add_done_callback(lambda f: Event._log_failure(sub, f))
+
+    @staticmethod
+    def _log_failure(sub: Callable, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f'Event subscriber {sub} failed', exc_info=future.exception())
+
+    def _dispatch(self, sender: object, event: object) -> None:
+        """Queues an invocation and starts draining the queue on the shared executor if it is not already.
+        Only one drain runs per event at a time, so subscribers see invocations in the order they were raised."""
+        with self._lock:
+            if self._queue is None:
+                self._queue = deque()
+            self._queue.append((sender, event, self._subscriptions))
+            if self._draining:
+                return
+            self._draining = True
+        get_executor().submit(self._drain)
+
+    def _drain(self) -> None:
+        while True:
+            with self._lock:
+                if len(self._queue) == 0:
+                    self._draining = False
+                    return
+                sender, event, subscriptions = self._queue.popleft()
+            for sub, loop in subscriptions:
+                try:
+                    if loop is None:
+                        sub(sender, event)
+                    else:
+                        self._schedule(sub, loop, sender, event)
+                except Exception:
+                    logging.exception(f'Event subscriber {sub} failed')
+
     def __len__(self):
-        return len(self.subscriptions)
+        return len(self._subscriptions)
 
     @property
     def value(self):
         """A property to return the last event emitted."""
-        return self._last_event
\ No newline at end of file
+        return self._last_event
@@ -0,0 +1,14 @@
+import sys
+from functools import lru_cache
+from uuid import uuid5, NAMESPACE_X500
+
+@lru_cache(maxsize=8192)
+def entity_id(name: str) -> str:
+    """Returns the uuid5 id of a device, service or system name.
+    Recently used names are cached so rebuilding systems does not hash every name again,
+    entity_id.cache_info() reports the hits, misses and size of the cache."""
+    return str(uuid5(NAMESPACE_X500, name))
+
+def intern_name(name: str) -> str:
+    """Interns an entity name so every entity and index holding it shares one string."""
+    return sys.intern(name) if type(name) is str else name
@@ -0,0 +1,134 @@
+import importlib, json, logging
+from typing import Dict, Iterator, List
+from .device import DeviceBase
+from .service import ServiceBase
+from .serialization import attribute_name, get_plan
+from .system import System
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+class ConfigurationError(ValueError):
+    """Raised when a system configuration file cannot be loaded, naming the file and line at fault."""
+
+def load_systems(path: str, service: object = None) -> List[System]:
+    """Builds the systems described by a configuration file and, if a service such as WebsocketService
+    is given, registers them all with it in a single call to its register_systems.
+    A .json file holds one system or a list of systems in the same shape as their JSON representation.
+    A .ndjson or .jsonl file is read a line at a time, each line holding one object: an object with
+    Type System starts a new system, along with any Devices and Services it lists, and every device or
+    service after it is added to that system.
+    Ids are always derived from names, so any Id in the file is ignored. Keys naming framework or excluded
+    attributes, such as SystemUpdate, DeviceUpdate, JsonExcludedProperties or Version, are rejected."""
+    if path.lower().endswith(NDJSON_EXTENSIONS):
+        systems = list(_load_ndjson(path))
+    else:
+        systems = _load_json(path)
+    if service is not None:
+        service.register_systems(systems)
+    logging.info(f'Loaded {len(systems)} systems from {path}')
+    return systems
+
+def _load_json(path: str) -> List[System]:
+    with open(path, encoding='utf-8') as file:
+        try:
+            config = json.load(file)
+        except json.JSONDecodeError as ex:
+            raise ConfigurationError(f'{path}:{ex.lineno}: {ex.msg}') from ex
+    systems = []
+    for entry in config if isinstance(config, list) else [config]:
+        system = _create_system(entry, path)
+        _add_entities(system, entry, f'{path}: {system.name}')
+        systems.append(system)
+    return systems
+
+def _load_ndjson(path: str) -> Iterator[System]:
+    system: System = None
+    with open(path, encoding='utf-8') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            location = f'{path}:{number}'
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as ex:
+                raise ConfigurationError(f'{location}: {ex.msg}') from ex
+            if isinstance(entry, dict) and entry.get('Type') == 'System':
+                if system is not None:
+                    yield system
+                system = _create_system(entry, location)
+                _add_entities(system, entry, location)
+            elif system is None:
+                raise ConfigurationError(f'{location}: expected a System before any devices or services')
+            else:
+                _add_entity(system, entry, location)
+    if system is not None:
+        yield system
+
+def _create_system(entry: Dict, location: str) -> System:
+    if not isinstance(entry, dict) or not isinstance(entry.get('Name'), str):
+        raise ConfigurationError(f'{location}: a System needs a Name')
+    system = System(entry['Name'])
+    _set_properties(system, entry, ('Type', 'Id', 'Name', 'Devices', 'Services'), location, f'System {system.name}')
+    return system
+
+def _set_properties(obj: object, entry: Dict, skipped: tuple, location: str, label: str) -> None:
+    """Sets the attributes named by an entry's keys, accepting only keys the object serializes under the same name."""
+    for key, value in entry.items():
+        if key in skipped:
+            continue
+        attribute = attribute_name(type(obj), key)
+        if get_plan(obj).key(attribute) != key:
+            raise ConfigurationError(f'{location}: {key} is not a configurable property of {label}')
+        try:
+            setattr(obj, attribute, value)
+        except Exception as ex:
+            raise ConfigurationError(f'{location}: {key} of {label} cannot be set: {ex}') from ex
+
+def _add_entities(system: System, entry: Dict, location: str) -> None:
+    """Adds the Devices and Services listed within a system's entry."""
+    for key, kind in (('Devices', 'device'), ('Services', 'service')):
+        entities = entry.get(key, [])
+        if not isinstance(entities, list):
+            raise ConfigurationError(f'{location}: {key} of System {system.name} must be a list')
+        for entity in entities:
+            _add_entity(system, entity, location, kind)
+
+def _add_entity(system: System, entry: Dict, location: str, kind: str = None) -> None:
+    """Validates an entity against the device and service registries and adds it to the system.
+    Kind limits the entity to a device or a service, otherwise the registry holding its Type decides."""
+    if not isinstance(entry, dict) or not isinstance(entry.get('Name'), str) or not isinstance(entry.get('Type'), str):
+        raise ConfigurationError(f'{location}: devices and services need a Name and a Type')
+    entity_kind = _resolve_kind(entry['Type'])
+    if entity_kind is None or (kind is not None and kind != entity_kind):
+        raise ConfigurationError(f'{location}: {entry["Type"]} is not a known {kind or "device or service"} type')
+    registry = DeviceBase.registry if entity_kind == 'device' else ServiceBase.registry
+    label = f'{entry["Type"]} {entry["Name"]}'
+    try:
+        entity = registry[entry['Type']](entry['Name'])
+    except Exception as ex:
+        raise ConfigurationError(f'{location}: {label} could not be created: {ex}') from ex
+    _set_properties(entity, entry, ('Type', 'Id', 'Name'), location, label)
+    if entity_kind == 'device':
+        system.devices.append(entity)
+    else:
+        system.services.append(entity)
+
+_imported = False
+
+def _resolve_kind(name: str) -> str:
+    """Returns whether a type name is a device or a service, or None if it is neither.
+    The project's devices and services are imported once if the name is not yet registered."""
+    global _imported
+    if name not in DeviceBase.registry and name not in ServiceBase.registry and not _imported:
+        _imported = True
+        for module in ('modules.devices', 'modules.services'):
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                logging.debug(f'{module} could not be imported while resolving {name}')
+    if name in DeviceBase.registry:
+        return 'device'
+    if name in ServiceBase.registry:
+        return 'service'
+    return None
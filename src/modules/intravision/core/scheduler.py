@@ -0,0 +1,55 @@
+import heapq, itertools, logging, threading
+from time import monotonic
+from typing import Callable, Dict, Hashable, List, Tuple
+
+class UpdateScheduler:
+    """Runs deferred entity updates from a single worker thread.
+    Pending updates are kept in a heap ordered by due time alongside a dirty set keyed by entity,
+    so any number of requests for the same entity before it is due collapse into one callback.
+    The worker thread is started on first use and shared by every entity."""
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._pending: Dict[Hashable, Callable] = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable) -> bool:
+        """Schedules callback to run after delay seconds unless an update for key is already pending.
+        Returns True if a new update was scheduled."""
+        with self._condition:
+            if key in self._pending:
+                return False
+            self._pending[key] = callback
+            heapq.heappush(self._heap, (monotonic() + max(delay, 0), next(self._counter), key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='UpdateScheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return True
+
+    def is_pending(self, key: Hashable) -> bool:
+        return key in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while len(self._heap) == 0:
+                    self._condition.wait()
+                due, _, key = self._heap[0]
+                remaining = due - monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                callback = self._pending.pop(key)
+            try:
+                callback()
+            except Exception:
+                logging.exception(f'Scheduled update for {key} failed')
+
+update_scheduler = UpdateScheduler()
@@ -0,0 +1,104 @@
+import re
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Tuple
+
+@lru_cache(maxsize=1024)
+def snake_to_pascal(s: str) -> str:
+    a = s.split('_')
+    a[0] = a[0].title()
+    if len(a) > 1:
+        a[1:] = [u.title() for u in a[1:]]
+    return ''.join(a)
+
+@lru_cache(maxsize=1024)
+def pascal_to_snake(s: str) -> str:
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', s).lower()
+
+_attribute_names: Dict[type, Dict[str, str]] = {}
+
+def attribute_name(cls: type, key: str) -> str:
+    """Returns the attribute name a PascalCase JSON key is loaded into for cls, caching the conversion per class."""
+    names = _attribute_names.get(cls)
+    if names is None:
+        names = _attribute_names.setdefault(cls, {})
+    name = names.get(key)
+    if name is None:
+        name = names[key] = pascal_to_snake(key)
+    return name
+
+class SerializationPlan:
+    """The precomputed JSON layout of a class for a given set of excluded properties.
+    Holds the PascalCase key for every attribute name seen so far and the getters of every
+    property defined on the class or its bases, so reprJSON does no string work per call."""
+    __slots__ = ('cls', 'excluded', 'properties', '_keys')
+
+    def __init__(self, cls: type, excluded: frozenset):
+        self.cls = cls
+        self.excluded = excluded
+        self._keys: Dict[str, str] = {}
+        properties: Dict[str, property] = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, property):
+                    properties[name] = value
+        self.properties: Tuple[Tuple[str, Callable], ...] = tuple((self.key(name), value.fget) for name, value in properties.items() if self.key(name) and value.fget is not None)
+
+    def key(self, name: str) -> str:
+        """Returns the JSON key for an attribute name, or an empty string if it is excluded."""
+        key = self._keys.get(name)
+        if key is None:
+            key = '' if name in self.excluded or name.startswith('_') else snake_to_pascal(name)
+            self._keys[name] = key
+        return key
+
+    def serialize(self, obj: object) -> Dict:
+        d = {}
+        keys = self._keys
+        for name, value in obj.__dict__.items():
+            key = keys.get(name)
+            if key is None:
+                key = self.key(name)
+            if key:
+                d[key] = value
+        for key, fget in self.properties:
+            d[key] = fget(obj)
+        return d
+
+class ExclusionList(list):
+    """A list of attribute names excluded from JSON.
+    Remembers the serialization plan built from it and forgets it whenever the list is changed."""
+    __slots__ = ('plan',)
+
+    def __init__(self, iterable: Iterable[str] = ()):
+        super().__init__(iterable)
+        self.plan: SerializationPlan = None
+
+def _invalidating(method: Callable) -> Callable:
+    def wrapper(self, *args):
+        self.plan = None
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(ExclusionList, _name, _invalidating(getattr(list, _name)))
+
+_plans: Dict[Tuple[type, frozenset], SerializationPlan] = {}
+
+def get_plan(obj: object) -> SerializationPlan:
+    """Returns the serialization plan for obj, building and caching it on first use."""
+    core = getattr(obj, '_core', None)
+    excluded = core.excluded if core is not None else obj.json_excluded_properties
+    plan = excluded.plan if isinstance(excluded, ExclusionList) else None
+    if plan is None or plan.cls is not type(obj):
+        key = (type(obj), frozenset(excluded))
+        plan = _plans.get(key)
+        if plan is None:
+            plan = _plans.setdefault(key, SerializationPlan(*key))
+        if isinstance(excluded, ExclusionList):
+            excluded.plan = plan
+    return plan
+
+def serialize(obj: object) -> Dict:
+    """Builds the PascalCase JSON representation of an entity using its cached serialization plan."""
+    return get_plan(obj).serialize(obj)
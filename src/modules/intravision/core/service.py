@@ -1,90 +1,232 @@
 from abc import ABC
+from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime, timedelta
 import importlib
 import json
 import logging
-import re
-from threading import Thread
-from time import sleep
-from typing import Dict
-from uuid import NAMESPACE_X500, uuid5
+from time import monotonic_ns
+from typing import Dict, Type
 from .event import Event
+from .serialization import ExclusionList, attribute_name, get_plan, serialize, snake_to_pascal
+from .scheduler import update_scheduler
+from .entity import _EntityCore, _ExclusionView, _control_attribute, _control_value
+from .ids import entity_id, intern_name
 
 @dataclass
 class ServiceUpdateEvent:
     service: 'ServiceBase'
+    changes: Dict[str, any] = None
+    """The PascalCase properties changed since the last update, or None for a full update."""
 
 class ServiceBase(ABC):
+    update_interval: float = 0.15
+    """The minimum number of seconds between update events, set on a subclass or an instance to change it."""
+    registry: Dict[str, Type['ServiceBase']] = {}
+    """Every service class by name, filled in as subclasses are defined."""
+
+    _shared_exclusions = ExclusionList([
+        'service_update',
+        'json_excluded_properties',
+        'update_interval'
+    ])
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        ServiceBase.registry[cls.__name__] = cls
+        # Each class gets its own copy of its parent's exclusions, extended by any declared in the class body.
+        inherited = super(cls, cls)._shared_exclusions
+        declared = cls.__dict__.get('_shared_exclusions', ())
+        cls._shared_exclusions = ExclusionList(inherited + [name for name in declared if name not in inherited])
+
     def __init__(self, name: str = None):
         if name == None:
-            raise Exception(f'{self.type} instantiated without a name')
-        self.id: str = str(uuid5(NAMESPACE_X500, name))
-        self.name: str = name
-        self.type = type(self).__name__
-        self.service_update: Event = Event(self)
-        self.json_excluded_properties = [
-            'device_update',
-            'json_excluded_properties'
-        ]
-
-        self.__last_update = datetime.min
-        self.__update_interval = timedelta(milliseconds=150)
-        self.__update_thread = None
+            raise Exception(f'{type(self).__name__} instantiated without a name')
+        name = intern_name(name)
+        self._core = _EntityCore(entity_id(name), name, type(self).__name__, Event(self), type(self)._shared_exclusions)
+
+    @property
+    def id(self) -> str:
+        return self._core.id
+
+    @id.setter
+    def id(self, value: str):
+        self._core.id = value
+
+    @property
+    def name(self) -> str:
+        return self._core.name
+
+    @name.setter
+    def name(self, value: str):
+        self._core.name = value
+
+    @property
+    def type(self) -> str:
+        return self._core.type
+
+    @type.setter
+    def type(self, value: str):
+        self._core.type = value
+
+    @property
+    def service_update(self) -> Event:
+        return self._core.update
+
+    @service_update.setter
+    def service_update(self, value: Event):
+        self._core.update = value
+
+    @property
+    def json_excluded_properties(self) -> ExclusionList:
+        """The attributes left out of the JSON representation.
+        Instances share their class's list until it is first changed here, when they are given their own copy to change."""
+        return _ExclusionView(self._core, type(self)._shared_exclusions)
+
+    @json_excluded_properties.setter
+    def json_excluded_properties(self, value: ExclusionList):
+        self._core.excluded = _ExclusionView.unwrap(value, self._core)
 
     def request_update(self):
-        if datetime.now() - self.__last_update > self.__update_interval:
-            self.__last_update = datetime.now()
-            self.service_update.invoke(self, ServiceUpdateEvent(self))
-        elif self.__update_thread == None:
-            self.__update_thread = Thread(target=self.__update, daemon=True)
-            self.__update_thread.start()
+        """Requests a full update of the service, sent to subscribers as a complete snapshot."""
+        with self._core.lock:
+            self._core.full_update = True
+        self.__request_update()
+
+    def __request_update(self):
+        """Raises the update event immediately if the update interval has elapsed on the monotonic clock,
+        otherwise schedules a single trailing update for the end of the interval so the final state is always sent."""
+        core = self._core
+        with core.lock:
+            if core.batch is not None or update_scheduler.is_pending(self):
+                return
+            now = monotonic_ns()
+            interval = int(self.update_interval * 1_000_000_000)
+            if core.last_update is not None and now - core.last_update < interval:
+                update_scheduler.schedule(self, (core.last_update + interval - now) / 1_000_000_000, self.__update)
+                return
+            core.last_update = now
+            update = self.__take_update()
+        if update is not None:
+            core.update.invoke(self, update)
 
     def __update(self):
-        sleep(self.__update_interval.total_seconds() - (datetime.now() - self.__last_update).total_seconds())
-        self.service_update.invoke(self, ServiceUpdateEvent(self))
-        self.__update_thread = None
-    
+        core = self._core
+        with core.lock:
+            if core.batch is not None:
+                # The batch sends its changes when it closes.
+                return
+            core.last_update = monotonic_ns()
+            update = self.__take_update()
+        if update is not None:
+            core.update.invoke(self, update)
+
+    def __take_update(self) -> ServiceUpdateEvent:
+        """Returns the pending update, or None if nothing has changed since the last one."""
+        core = self._core
+        changes, core.changes = core.changes, None
+        if core.full_update:
+            core.full_update = False
+            return ServiceUpdateEvent(self)
+        if not changes:
+            return None
+        plan = get_plan(self)
+        return ServiceUpdateEvent(self, {plan.key(k): getattr(self, k) for k in changes if plan.key(k)})
+
     def update_property(self, property: str, value):
+        if self.__check_property(property, value):
+            self.__set_property(property, value)
+            self.__request_update()
+
+    def update_properties(self, values: Dict[str, any]):
+        """Updates several properties as one batch, sent as a single update or patch.
+        Every value's type is checked before any is set, and nothing is set if one of them does not match."""
+        if not all([self.__check_property(property, value) for property, value in values.items()]):
+            return
+        with self.batch():
+            for property, value in values.items():
+                self.__set_property(property, value)
+
+    def __check_property(self, property: str, value) -> bool:
         if not hasattr(self, property):
             logging.error(f'{self.name} does not contain property: {property}')
-            return
+            return False
         if type(getattr(self, property)) != type(value):
             logging.error(f'{self.name} trying to set {property} of type {type(getattr(self, property))} to value of type {type(value)}')
-            return
-        if getattr(self, property) != value:
+            return False
+        return True
+
+    def __set_property(self, property: str, value):
+        core = self._core
+        with core.batch_lock, core.lock:
+            if getattr(self, property) == value:
+                return
+            if core.batch is not None and property not in core.batch:
+                core.batch[property] = getattr(self, property)
             setattr(self, property, value)
-            self.request_update()
+            if core.changes is None:
+                core.changes = set()
+            core.changes.add(property)
+
+    @contextmanager
+    def batch(self):
+        """Groups property updates so they are sent as one update or patch when the block exits.
+        Property updates from other threads wait for the block, while trailing updates due during it are left
+        for the block to send. If the outermost block raises, the properties changed within it are restored
+        and nothing is sent."""
+        core = self._core
+        with core.batch_lock:
+            with core.lock:
+                outer = core.batch is None
+                if outer:
+                    core.batch = {}
+                    changes, full_update = (set(core.changes) if core.changes else None), core.full_update
+            try:
+                yield self
+            except BaseException:
+                if outer:
+                    with core.lock:
+                        for property, value in core.batch.items():
+                            setattr(self, property, value)
+                        core.changes, core.full_update = changes, full_update
+                raise
+            finally:
+                if outer:
+                    with core.lock:
+                        core.batch = None
+        if outer and (core.changes or core.full_update):
+            self.__request_update()
+
+    def control(self, property: str, value):
+        """Handles a control request from a front end for the PascalCase property given.
+        By default the matching property is updated, services override this to send commands to the service.
+        Only properties the service serializes can be controlled, framework, excluded and private attributes raise ValueError,
+        as does a value of the wrong type."""
+        attribute = _control_attribute(self, property)
+        self.update_property(attribute, _control_value(self, attribute, value))
 
     def reprJSON(self) -> Dict:
-        d = {self._snake_to_pascal(k): v for k, v in self.__dict__.items() if k not in self.json_excluded_properties and not k.startswith('_')}.copy()
-        for key, value in self.__class__.__dict__.items():
-            if isinstance(value, property):
-                d[self._snake_to_pascal(key)] = getattr(self, key)
-        return d
+        return serialize(self)
     
     def _snake_to_pascal(self, s):
-        a = s.split('_')
-        a[0] = a[0].title()
-        if len(a) > 1:
-            a[1:] = [u.title() for u in a[1:]]
-        return ''.join(a)
+        return snake_to_pascal(s)
     
     def __repr__(self):
         return str(self.reprJSON())
     
 class ServiceSerialization(json.JSONEncoder):
     @classmethod
-    def deserialize_device(cls, jdict: Dict):
+    def deserialize_service(cls, jdict: Dict):
         if 'Type' in jdict:
-            device_class =  getattr(importlib.import_module('modules.services'), jdict['Type'])
-            response = device_class(jdict['Name'])
+            service_class = ServiceBase.registry.get(jdict['Type'])
+            if service_class is None:
+                # Classes are registered when their module is imported, load the project's services if this one was not.
+                service_class = getattr(importlib.import_module('modules.services'), jdict['Type'])
+            response = service_class(jdict['Name'])
             for key, value in jdict.items():
-                setattr(response, cls.__pascal_to_snake(key), value)
+                setattr(response, attribute_name(service_class, key), value)
             return response
         else:
             return jdict
-    
-    @staticmethod
-    def __pascal_to_snake(s) -> str:
-        return re.sub(r'(?<!^)(?=[A-Z])', '_', s).lower()
\ No newline at end of file
+
+    deserialize_device = deserialize_service
+    """The original name of deserialize_service, kept for existing callers."""
@@ -1,43 +1,59 @@
-import json, importlib, re
+import json, importlib, re, itertools
 from dataclasses import dataclass
-from uuid import uuid5, NAMESPACE_X500
 from typing import List, Dict
 from .device import DeviceBase
 from .service import ServiceBase
 from .event import Event
+from .ids import entity_id, intern_name
+from .serialization import ExclusionList, serialize, snake_to_pascal
 
 @dataclass
 class SystemUpdateEvent:
     system: 'System'
+    changes: Dict[str, any] = None
+    """The PascalCase properties changed, or None when the system's devices or services have changed and a full update is needed."""
 
 class System:
     def __init__(self, name):
-        self.id: str = str(uuid5(NAMESPACE_X500, name))
+        name = intern_name(name)
+        self.id: str = entity_id(name)
         self.name: str = name
         self.devices: List[DeviceBase] = []
         self.services: List[ServiceBase] = []
+        self.power: bool = False
         self.system_update: Event = Event(self)
-        self.json_excluded_properties = [
+        self.json_excluded_properties = ExclusionList([
             'system_update',
-            'json_excluded_properties'
-        ]
+            'json_excluded_properties',
+            'version'
+        ])
+        self._versions = itertools.count(1)
+        self._version = 0
     
+    @property
+    def version(self) -> int:
+        """A counter that increases whenever the system or any of its devices or services is updated."""
+        return self._version
+
+    def bump_version(self) -> int:
+        self._version = next(self._versions)
+        return self._version
+
+    def set_power(self, state: bool):
+        if self.power != state:
+            self.power = state
+            self.bump_version()
+            self.system_update.invoke(self, SystemUpdateEvent(self, {'Power': state}))
+
     def request_update(self):
+        self.bump_version()
         self.system_update.invoke(self, SystemUpdateEvent(self))
 
     def reprJSON(self) -> Dict:
-        d = {self._snake_to_pascal(k): v for k, v in self.__dict__.items() if k not in self.json_excluded_properties and not k.startswith('_')}.copy()
-        for key, value in self.__class__.__dict__.items():
-            if isinstance(value, property):
-                d[self._snake_to_pascal(key)] = getattr(self, key)
-        return d
+        return serialize(self)
     
     def _snake_to_pascal(self, s):
-        a = s.split('_')
-        a[0] = a[0].title()
-        if len(a) > 1:
-            a[1:] = [u.title() for u in a[1:]]
-        return ''.join(a)
+        return snake_to_pascal(s)
     
     def __repr__(self):
         return str(self.reprJSON())
@@ -1,22 +1,39 @@
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from datetime import datetime
+from enum import Enum
 from http import HTTPStatus
-import json
-import asyncio, threading, logging
-from typing import List, Dict
+import json, gzip, hashlib, itertools, email.utils, re
+import asyncio, threading, logging, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, List, Dict, Set, Tuple
+from uuid import UUID, uuid4
 from modules.intravision.core import System, DeviceBase, ServiceBase, SystemUpdateEvent, DeviceUpdateEvent, ServiceUpdateEvent
 from modules.libraries.websockets.asyncio.server import serve, ServerConnection, Request
+from modules.libraries.websockets.exceptions import ConnectionClosed
+from modules.libraries.websockets.datastructures import Headers
+from modules.libraries.websockets.frames import CloseCode
+from modules.libraries.websockets.http11 import Response
+from modules.helper.msgpack import PackException, packb, unpackb
 
-@dataclass
 class WebsocketMessage:
-    Event: str
-    Data: any
-    SystemID: str
+    """The envelope for every message exchanged with a front end."""
+    __slots__ = ('Event', 'Data', 'SystemID', 'CorrelationID', 'Sequence')
+
+    def __init__(self, Event: str, Data: any = None, SystemID: str = None, CorrelationID: str = None, Sequence: int = None):
+        self.Event = Event
+        self.Data = Data
+        self.SystemID = SystemID
+        self.CorrelationID = CorrelationID
+        """Optional id chosen by the client, echoed on the Ack or Error sent once the message has been handled."""
+        self.Sequence = Sequence
+        """The position of an outbound update in its system's update stream."""
 
     def reprJSON(self) -> Dict:
-        d = {k: v for k, v in self.__dict__.items()}.copy()
-        for key, value in self.__class__.__dict__.items():
-            if isinstance(value, property):
-                d[key] = getattr(self, key)
+        d = {'Event': self.Event, 'Data': self.Data, 'SystemID': self.SystemID}
+        if self.CorrelationID is not None:
+            d['CorrelationID'] = self.CorrelationID
+        if self.Sequence is not None:
+            d['Sequence'] = self.Sequence
         return d
     
     def __repr__(self):
@@ -29,36 +46,353 @@ class ComplexEncoder(json.JSONEncoder):
         else:
             return json.JSONEncoder.default(self, obj)
     
+JSON_SUBPROTOCOL = 'intravision.json'
+MSGPACK_SUBPROTOCOL = 'intravision.msgpack'
+SUBPROTOCOLS = [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL]
+"""Subprotocols in order of preference. Clients that offer none are served JSON."""
+
+def _repr_msgpack(obj):
+    if hasattr(obj, 'reprJSON'):
+        return obj.reprJSON()
+    raise PackException(f'Object of type {type(obj).__name__} is not MessagePack serializable')
+
+def encode_message(message: 'WebsocketMessage', binary: bool = False) -> bytes:
+    """Encodes a message as MessagePack for binary clients or UTF-8 JSON otherwise."""
+    if binary:
+        return packb(message, default=_repr_msgpack)
+    return json.dumps(message, cls=ComplexEncoder).encode()
+
+class MessageDecodeError(ValueError):
+    def __init__(self, reason: str, message: WebsocketMessage = None):
+        super().__init__(reason)
+        self.message = message
+        """The envelope decoded so far, if any, so the sender can still be answered."""
+
+ENVELOPE_SCAN_THRESHOLD = 1024
+"""Text frames longer than this are decoded member by member, shorter ones cost less to parse in one call."""
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING_OR_BRACKET = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+_scan_once = json.JSONDecoder().scan_once
+
+def _skip_value(text: str, idx: int) -> int:
+    """Returns the index just past the JSON value starting at idx.
+    Objects and arrays are skipped by matching brackets outside strings without building them.
+    This is slower than the C scanner for valid payloads so it is only used for messages being rejected."""
+    if text[idx:idx + 1] not in ('{', '['):
+        try:
+            return _scan_once(text, idx)[1]
+        except StopIteration:
+            raise MessageDecodeError(f'Expecting value at {idx}')
+        except json.JSONDecodeError as ex:
+            raise MessageDecodeError(str(ex))
+    depth = 0
+    for match in _STRING_OR_BRACKET.finditer(text, idx):
+        token = match.group()
+        if token[0] == '"':
+            continue
+        depth += 1 if token in '{[' else -1
+        if depth == 0:
+            return match.end()
+    raise MessageDecodeError(f'Unterminated value at {idx}')
+
 class WebsocketMessageEncoder(json.JSONEncoder):
     @classmethod
-    def deserialize_websocket_message(cls, jdict: Dict):
-        if 'SystemID' in jdict:
-            message = WebsocketMessage(**jdict)
-            return message
+    def decode(cls, message: str | bytes, events: Set[str] = None) -> WebsocketMessage:
+        """Decodes an inbound text frame as JSON or a binary frame as MessagePack.
+        JSON frames are parsed without an object hook. Large frames are scanned member by member so
+        Data is skipped rather than parsed when the Event has already been found not to be in events.
+        Raises MessageDecodeError if the frame is malformed, its SystemID or CorrelationID is not a string
+        or its Event is not in events."""
+        if isinstance(message, str):
+            decoded = cls._decode_envelope(message, events) if len(message) > ENVELOPE_SCAN_THRESHOLD else cls._decode_small(message)
         else:
-            return jdict
+            try:
+                jdict = unpackb(message)
+                decoded = WebsocketMessage(jdict['Event'], jdict.get('Data'), jdict.get('SystemID'), jdict.get('CorrelationID'))
+            except (PackException, TypeError, KeyError) as ex:
+                raise MessageDecodeError(f'Invalid binary message: {ex}') from ex
+        if decoded.CorrelationID is not None and not isinstance(decoded.CorrelationID, str):
+            raise MessageDecodeError(f'CorrelationID must be a string, received {decoded.CorrelationID!r}')
+        if decoded.SystemID is not None and not isinstance(decoded.SystemID, str):
+            system_id, decoded.SystemID = decoded.SystemID, None
+            raise MessageDecodeError(f'SystemID must be a string, received {system_id!r}', decoded)
+        if not isinstance(decoded.Event, str):
+            raise MessageDecodeError('Message has no Event', decoded)
+        if events is not None and decoded.Event not in events:
+            raise MessageDecodeError(f'Unknown event: {decoded.Event}', decoded)
+        return decoded
+
+    @staticmethod
+    def _decode_small(text: str) -> WebsocketMessage:
+        try:
+            jdict = json.loads(text)
+        except json.JSONDecodeError as ex:
+            raise MessageDecodeError(str(ex))
+        except RecursionError:
+            raise MessageDecodeError('Message is nested too deeply')
+        if not isinstance(jdict, dict):
+            raise MessageDecodeError('Message is not a JSON object')
+        return WebsocketMessage(jdict.get('Event'), jdict.get('Data'), jdict.get('SystemID'), jdict.get('CorrelationID'))
+
+    @staticmethod
+    def _decode_envelope(text: str, events: Set[str] = None) -> WebsocketMessage:
+        whitespace = _WHITESPACE.match
+        fields = {}
+        rejected = skipped = False
+        idx = whitespace(text, 0).end()
+        if text[idx:idx + 1] != '{':
+            raise MessageDecodeError('Message is not a JSON object')
+        idx = whitespace(text, idx + 1).end()
+        if text[idx:idx + 1] == '}':
+            raise MessageDecodeError('Message has no Event')
+        while True:
+            if text[idx:idx + 1] != '"':
+                raise MessageDecodeError(f'Expecting property name at {idx}')
+            try:
+                key, idx = json.decoder.scanstring(text, idx + 1)
+            except json.JSONDecodeError as ex:
+                raise MessageDecodeError(str(ex))
+            idx = whitespace(text, idx).end()
+            if text[idx:idx + 1] != ':':
+                raise MessageDecodeError(f"Expecting ':' at {idx}")
+            idx = whitespace(text, idx + 1).end()
+            if key == 'Data' and rejected:
+                idx = _skip_value(text, idx)
+                skipped = True
+            elif key == 'Event' and skipped:
+                # Data was skipped for the earlier Event, so a later Event cannot be handled.
+                raise MessageDecodeError(f'Event repeated after its Data was skipped at {idx}')
+            else:
+                try:
+                    fields[key], idx = _scan_once(text, idx)
+                except StopIteration:
+                    raise MessageDecodeError(f'Expecting value at {idx}')
+                except json.JSONDecodeError as ex:
+                    raise MessageDecodeError(str(ex))
+                except RecursionError:
+                    raise MessageDecodeError(f'Value nested too deeply at {idx}')
+                if key == 'Event' and events is not None:
+                    # decode rejects an Event that is not a string once the rest of the envelope is known.
+                    rejected = not isinstance(fields[key], str) or fields[key] not in events
+            idx = whitespace(text, idx).end()
+            separator = text[idx:idx + 1]
+            idx = whitespace(text, idx + 1).end()
+            if separator == '}':
+                break
+            if separator != ',':
+                raise MessageDecodeError(f"Expecting ',' at {idx}")
+        if idx != len(text):
+            raise MessageDecodeError(f'Extra data at {idx}')
+        return WebsocketMessage(fields.get('Event'), fields.get('Data'), fields.get('SystemID'), fields.get('CorrelationID'))
+
+class SlowConsumerPolicy(str, Enum):
+    """What a client's send queue does when it reaches its high-water mark.
+    DropOldest discards the oldest queued frame, Coalesce replaces a queued frame for the same entity
+    before falling back to dropping the oldest, and Disconnect closes the connection."""
+    DROP_OLDEST = 'DropOldest'
+    COALESCE = 'Coalesce'
+    DISCONNECT = 'Disconnect'
+
+class SubscriptionFilter:
+    """Narrows the device and service updates a client receives.
+    Each of devices, services and properties is None until subscribed to, meaning no restriction.
+    Property names are the PascalCase keys used in patches. Full updates are not restricted by property."""
+    __slots__ = ('devices', 'services', 'properties')
+
+    def __init__(self) -> None:
+        self.devices: Set[str] = None
+        self.services: Set[str] = None
+        self.properties: Set[str] = None
+
+    def subscribe(self, data: Dict) -> None:
+        """Adds the Devices, Services and Properties lists in data to the filter."""
+        for name, values in self._fields(data):
+            current = getattr(self, name)
+            setattr(self, name, set(values) if current is None else current | set(values))
+
+    def unsubscribe(self, data: Dict) -> None:
+        """Removes the Devices, Services and Properties lists in data from the filter.
+        A field left empty is reset to None, so unsubscribing from everything in it lifts its restriction."""
+        for name, values in self._fields(data):
+            current = getattr(self, name)
+            if current is not None:
+                current.difference_update(values)
+                if len(current) == 0:
+                    setattr(self, name, None)
+
+    @staticmethod
+    def _fields(data: Dict) -> List[Tuple[str, List[str]]]:
+        if not isinstance(data, dict):
+            raise ValueError(f'Expected Devices, Services or Properties, received {data!r}')
+        fields = []
+        for key, name in (('Devices', 'devices'), ('Services', 'services'), ('Properties', 'properties')):
+            values = data.get(key)
+            if values is None:
+                continue
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f'{key} must be a list of strings')
+            fields.append((name, values))
+        return fields
+
+    def accepts(self, subject: Tuple[str, str, frozenset]) -> bool:
+        """Returns whether an update about subject, a tuple of entity kind, entity id and the
+        changed property names or None for a full update, passes the filter."""
+        kind, entity_id, changes = subject
+        ids = self.devices if kind == 'Device' else self.services
+        if ids is not None and entity_id not in ids:
+            return False
+        return changes is None or self.properties is None or not self.properties.isdisjoint(changes)
 
 class WebsocketClient:
-    def __init__(self, server_connection: ServerConnection, system_id: str) -> None:
+    """Tracks a single websocket connection from connect until disconnect.
+    The client only receives updates once it has initialised against a system.
+    Outbound frames are held in a bounded queue drained by the client's own writer task,
+    so a slow connection never holds up the fan-out to other clients."""
+
+    def __init__(self, server_connection: ServerConnection, high_water_mark: int = 256, policy: SlowConsumerPolicy = SlowConsumerPolicy.COALESCE) -> None:
         self.server_connection = server_connection
-        self.system_id = system_id
+        self.id = server_connection.id
+        self.binary = server_connection.subprotocol == MSGPACK_SUBPROTOCOL
+        self.system: System = None
+        """The system the client initialised against, cached so its messages skip the system lookup."""
+        self.subscriptions: SubscriptionFilter = None
+        """The updates the client has narrowed itself to, or None to receive every update of its system."""
+        self.connected_at: datetime = datetime.now()
+        self.initialised_at: datetime = None
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.dropped_frames = 0
+        self.closing = False
+        """Set once the client is being disconnected, after which no more frames are queued."""
+        self._queue: OrderedDict[object, Tuple[bytes, bool]] = OrderedDict()
+        self._queue_ready = asyncio.Event()
+        self._writer: asyncio.Task = None
+
+    @property
+    def system_id(self) -> str:
+        return self.system.id if self.system is not None else None
+
+    @property
+    def initialised(self) -> bool:
+        return self.system is not None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        """Starts the writer task on the running event loop."""
+        self._writer = asyncio.get_running_loop().create_task(self._write())
+
+    def stop(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._queue.clear()
+
+    def enqueue(self, frame: bytes, text: bool = True, key: object = None) -> bool:
+        """Queues an encoded frame for sending. Frames sharing a key belong to the same entity and may be coalesced.
+        Returns False if the frame was not queued because the client is being disconnected."""
+        if self.closing:
+            return False
+        if key is None or self.policy != SlowConsumerPolicy.COALESCE:
+            key = object()
+        elif key in self._queue:
+            self._queue[key] = (frame, text)
+            self._queue.move_to_end(key)
+            return True
+        if len(self._queue) >= self.high_water_mark:
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                logging.warning(f'Client {self.id} exceeded {self.high_water_mark} queued frames, disconnecting')
+                self.closing = True
+                self.stop()
+                asyncio.get_running_loop().create_task(self.server_connection.close(CloseCode.TRY_AGAIN_LATER, 'Slow consumer'))
+                return False
+            self._queue.popitem(last=False)
+            self.dropped_frames += 1
+        self._queue[key] = (frame, text)
+        self._queue_ready.set()
+        return True
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                await self._queue_ready.wait()
+                while len(self._queue) > 0:
+                    _, (frame, text) = self._queue.popitem(last=False)
+                    await self.server_connection.send(frame, text=text)
+                self._queue_ready.clear()
+        except ConnectionClosed:
+            logging.debug(f'Client {self.id} writer stopped, connection closed')
+
+class UpdateHistory:
+    """The sequence numbers and most recent update messages sent for one system.
+    Sequences start from the time the history was created in microseconds, so a sequence a client
+    remembers from before a server restart is always older than the history and gets a full snapshot."""
+
+    def __init__(self, size: int) -> None:
+        self.sequence = time.time_ns() // 1000
+        self._sequences = itertools.count(self.sequence + 1)
+        self._entries: deque[Tuple[int, WebsocketMessage, Dict[bool, bytes], Tuple]] = deque(maxlen=size)
+
+    def append(self, message: WebsocketMessage, subject: Tuple = None) -> Dict[bool, bytes]:
+        """Assigns the message the next sequence number and records it along with the subject it was filtered on.
+        Returns the frame cache for the message, keyed by wire format, to be filled as it is encoded."""
+        self.sequence = message.Sequence = next(self._sequences)
+        frames = {}
+        self._entries.append((self.sequence, message, frames, subject))
+        return frames
+
+    def since(self, sequence: int) -> List[Tuple[int, WebsocketMessage, Dict[bool, bytes], Tuple]]:
+        """Returns the updates after sequence, or None if some of them are no longer held."""
+        if sequence == self.sequence:
+            return []
+        if len(self._entries) == 0 or sequence > self.sequence or sequence < self._entries[0][0] - 1:
+            return None
+        return [entry for entry in self._entries if entry[0] > sequence]
 
 class WebsocketService(ServiceBase):
     """A websocket server to provide communications from an Intravision front end to devices within a system."""
 
     def __init__(self, name):
-        self._systems: List[System] = []
-        self._clients: List[WebsocketClient] = []
-        self._subscribed_devices: List[DeviceBase] = []
-        self._subscribed_services: List[ServiceBase] = []
-        self._loop = None
+        self._systems: Dict[str, System] = {}
+        self._clients: Dict[UUID, WebsocketClient] = {}
+        self._subscribed_devices: Set[DeviceBase] = set()
+        self._subscribed_services: Set[ServiceBase] = set()
+        self._device_systems: Dict[str, frozenset[System]] = {}
+        self._service_systems: Dict[str, frozenset[System]] = {}
+        self._devices: Dict[str, DeviceBase] = {}
+        self._services: Dict[str, ServiceBase] = {}
+        self._system_clients: Dict[str, Set[WebsocketClient]] = {}
+        self._system_entities: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}
+        self._histories: Dict[str, UpdateHistory] = {}
+        self._index_lock = threading.Lock()
+        self._registry_versions = itertools.count(1)
+        self._registry_version = 0
+        self._etag_prefix = uuid4().hex[:8]
+        self._systems_snapshot: Tuple[Tuple, str, bytes, bytes] = None
+        self._loop: asyncio.AbstractEventLoop = None
         self._stop = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._executor: ThreadPoolExecutor = None
+        self._handlers: Dict[str, Callable[[WebsocketClient, System, WebsocketMessage], Awaitable[None]]] = {}
         self.host = ""
         self.port = 50555
+        self.client_high_water_mark = 256
+        self.slow_consumer_policy = SlowConsumerPolicy.COALESCE
+        self.control_workers = 4
+        self.history_size = 256
         self.behaviour = self.intravision_control_behaviour
         self.quiet_logger = logging.getLogger("Quiet")
         self.quiet_logger.setLevel(logging.WARNING)
         super().__init__(name)
+        self.register_handler('Initialise', self._on_initialise)
+        self.register_handler('SetPower', self._on_set_power)
+        self.register_handler('ControlDevice', self._on_control_device)
+        self.register_handler('ControlService', self._on_control_service)
+        self.register_handler('Subscribe', self._on_subscribe)
+        self.register_handler('Unsubscribe', self._on_unsubscribe)
+        self.register_handler('Error', self._on_error)
 
     def shutdown(self) -> None:
         """Stops the websocket server, disconnecting all active sessions."""
@@ -70,49 +404,179 @@ class WebsocketService(ServiceBase):
         """Starts the websocket server on host and port specified within the WebsocketService object."""
         threading.Thread(target=self._start_loop, daemon=True).start()
 
+    def register_handler(self, event: str, handler: Callable[[WebsocketClient, System, WebsocketMessage], Awaitable[None]]) -> None:
+        """Registers a coroutine to handle inbound messages with the given event name, replacing any existing handler."""
+        self._handlers[event] = handler
+
     def register_system(self, system: System) -> None:
-        self._systems.append(system)
-        system.system_update += self._handle_system_update
-        for device in system.devices:
-            device.device_update += self._handle_device_update
-            self._subscribed_devices.append(device)
-        for service in system.services:
-            service.service_update += self._handle_service_update
-            self._subscribed_services.append(device)
+        self.register_systems((system,))
+
+    def register_systems(self, systems: Iterable[System]) -> None:
+        """Registers several systems at once, indexing all their devices and services under a single lock."""
+        added = []
+        for system in systems:
+            if system.id in self._systems:
+                logging.info(f'System {system.name} is already registered')
+                continue
+            self._systems[system.id] = system
+            self._system_clients.setdefault(system.id, set())
+            self._histories[system.id] = UpdateHistory(self.history_size)
+            system.system_update.subscribe(self._handle_system_update, weak=True)
+            added.append(system)
+        if len(added) > 0:
+            self._index_systems(added)
+            self._registry_version = next(self._registry_versions)
     
     def unregister_system(self, system: System) -> None:
-        try:
-            self._systems.remove(system)
-            system.system_update -= self._handle_system_update
-        except ValueError:
+        if self._systems.get(system.id) is not system:
             logging.info(f'System {system.name} cannot be removed as it is not currently registered')
+            return
+        del self._systems[system.id]
+        system.system_update -= self._handle_system_update
+        self._registry_version = next(self._registry_versions)
+        self._deindex_system(system)
+        self._detach_entities()
+        for client in self._system_clients.pop(system.id, ()):
+            client.system = None
+        self._histories.pop(system.id, None)
+
+    def _index_system(self, system: System) -> None:
+        self._index_systems((system,))
+
+    def _index_systems(self, systems: Iterable[System]) -> None:
+        """Brings the dispatch indexes up to date with systems' devices and services, subscribing to any not yet seen."""
+        with self._index_lock:
+            for system in systems:
+                self._index_system_locked(system)
+
+    def _deindex_system(self, system: System) -> None:
+        """Removes a system from the dispatch indexes using the entities recorded when it was last indexed."""
+        with self._index_lock:
+            self._index_system_locked(system, remove=True)
+
+    def _index_system_locked(self, system: System, remove: bool = False) -> None:
+        """Diffs a system's devices and services against those recorded when it was last indexed and updates only the ids that changed.
+        The id to systems sets are frozen and replaced rather than mutated, so update handlers and control messages
+        can read the indexes without the lock and never see an entity that stayed in the system missing from it."""
+        device_ids, service_ids = self._system_entities.pop(system.id, ((), ()))
+        devices = {} if remove else {device.id: device for device in system.devices}
+        services = {} if remove else {service.id: service for service in system.services}
+        for index, entities, subscribed, attribute, handler, old_ids, current in (
+                (self._device_systems, self._devices, self._subscribed_devices, 'device_update', self._handle_device_update, device_ids, devices),
+                (self._service_systems, self._services, self._subscribed_services, 'service_update', self._handle_service_update, service_ids, services)):
+            for entity_id, entity in current.items():
+                entities[entity_id] = entity
+                systems = index.get(entity_id, frozenset())
+                if system not in systems:
+                    index[entity_id] = systems | {system}
+                if entity not in subscribed:
+                    getattr(entity, attribute).subscribe(handler, weak=True)
+                    subscribed.add(entity)
+            for entity_id in old_ids:
+                if entity_id in current:
+                    continue
+                systems = index.get(entity_id)
+                if systems is None:
+                    continue
+                systems = systems - {system}
+                if len(systems) > 0:
+                    index[entity_id] = systems
+                else:
+                    del index[entity_id]
+                    entities.pop(entity_id, None)
+        if not remove:
+            self._system_entities[system.id] = (tuple(devices), tuple(services))
 
-    def _handle_system_update(self, sender: System, args: SystemUpdateEvent) -> None:  
-        for device in [device for device in args.system.devices if device not in self._subscribed_devices]:
-            device.device_update += self._handle_device_update
-            self._subscribed_devices.append(device)
-        for service in [service for service in args.system.services if service not in self._subscribed_services]:
-            service.service_update += self._handle_service_update
-            self._subscribed_services.append(service)
-        for client in [client for client in self._clients if client.system_id == args.system.id]:
-            asyncio.run(self._send_event(client, WebsocketMessage('Initialisation', args.system, client.system_id)))
+    def _detach_entities(self) -> None:
+        """Unsubscribes from devices and services that are no longer part of any registered system."""
+        with self._index_lock:
+            for subscribed, index, attribute, handler in (
+                    (self._subscribed_devices, self._device_systems, 'device_update', self._handle_device_update),
+                    (self._subscribed_services, self._service_systems, 'service_update', self._handle_service_update)):
+                for entity in [entity for entity in subscribed if entity.id not in index]:
+                    getattr(entity, attribute).unsubscribe(handler)
+                    subscribed.discard(entity)
 
+    def _handle_system_update(self, sender: System, args: SystemUpdateEvent) -> None:
+        if args.changes is not None:
+            patch = {'Id': args.system.id, 'Changes': args.changes}
+            self._call_in_loop(self._fan_out, 'SystemPatch', patch, (args.system,), ('SystemPatch', args.system.id, frozenset(args.changes)))
+            return
+        self._index_system(args.system)
+        self._detach_entities()
+        self._call_in_loop(self._fan_out, 'Initialisation', args.system, (args.system,), ('Initialisation', args.system.id))
 
     def _handle_device_update(self, sender: DeviceBase, args: DeviceUpdateEvent) -> None:
-        systems = [system for system in self._systems if args.device in system.devices]
-        clients = [client for client in self._clients if len([system for system in systems if system.id == client.system_id]) > 0]
-        for client in clients:
-            asyncio.run(self._send_event(client, WebsocketMessage('DeviceUpdate', args.device, client.system_id)))
+        systems = tuple(self._device_systems.get(args.device.id, ()))
+        for system in systems:
+            system.bump_version()
+        if args.changes is None:
+            self._call_in_loop(self._fan_out, 'DeviceUpdate', args.device, systems, ('DeviceUpdate', args.device.id), ('Device', args.device.id, None))
+        elif len(args.changes) > 0:
+            patch = {'Id': args.device.id, 'Changes': args.changes}
+            changed = frozenset(args.changes)
+            self._call_in_loop(self._fan_out, 'DevicePatch', patch, systems, ('DevicePatch', args.device.id, changed), ('Device', args.device.id, changed))
 
     def _handle_service_update(self, sender: ServiceBase, args: ServiceUpdateEvent) -> None:
-        systems = [system for system in self._systems if args.service in system.services]
-        clients = [client for client in self._clients if len([system for system in systems if system.id == client.system_id]) > 0]
-        for client in clients:
-            asyncio.run(self._send_event(client, WebsocketMessage('ServiceUpdate', args.service, client.system_id)))
+        systems = tuple(self._service_systems.get(args.service.id, ()))
+        for system in systems:
+            system.bump_version()
+        if args.changes is None:
+            self._call_in_loop(self._fan_out, 'ServiceUpdate', args.service, systems, ('ServiceUpdate', args.service.id), ('Service', args.service.id, None))
+        elif len(args.changes) > 0:
+            patch = {'Id': args.service.id, 'Changes': args.changes}
+            changed = frozenset(args.changes)
+            self._call_in_loop(self._fan_out, 'ServicePatch', patch, systems, ('ServicePatch', args.service.id, changed), ('Service', args.service.id, changed))
+
+    def _call_in_loop(self, coroutine_function: Callable, *args) -> None:
+        """Hands a coroutine over to the websocket event loop without blocking the calling thread.
+        Updates raised while the server is not running are dropped."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._create_task, coroutine_function, *args)
+        except RuntimeError:
+            logging.debug(f'Websocket loop closed, dropping {coroutine_function.__name__}')
+
+    def _create_task(self, coroutine_function: Callable, *args) -> None:
+        task = asyncio.get_running_loop().create_task(coroutine_function(*args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-    async def _send_event(self, client: WebsocketClient, message: WebsocketMessage) -> None:
-        await client.server_connection.send(json.dumps(message, cls=ComplexEncoder))
-        logging.debug(f'Sending to {client.server_connection.id}: {message}')
+    async def _fan_out(self, event: str, data: any, systems: Tuple[System], key: Tuple, subject: Tuple = None) -> None:
+        """Records the update in each system's history and queues the same encoded frame for every client of that system.
+        The key identifies the entity and message kind so a queued frame can be coalesced with a newer one.
+        The subject is checked against the subscriptions of clients that have narrowed their updates."""
+        for system in systems:
+            history = self._histories.get(system.id)
+            if history is None:
+                continue
+            message = WebsocketMessage(event, data, system.id)
+            frames = history.append(message, subject)
+            queued = 0
+            for client in tuple(self._system_clients.get(system.id, ())):
+                if subject is not None and client.subscriptions is not None and not client.subscriptions.accepts(subject):
+                    continue
+                if client.enqueue(self._get_frame(message, frames, client.binary), not client.binary, key):
+                    queued += 1
+                else:
+                    self._detach_client(client)
+            logging.debug(f'Queued {event} for {queued} clients of System {system.id}')
+
+    def _get_frame(self, message: WebsocketMessage, frames: Dict[bool, bytes], binary: bool) -> bytes:
+        frame = frames.get(binary)
+        if frame is None:
+            frame = frames[binary] = encode_message(message, binary)
+        return frame
+
+    def _send_event(self, client: WebsocketClient, message: WebsocketMessage) -> None:
+        client.enqueue(encode_message(message, client.binary), not client.binary, (message.Event, message.SystemID))
+        logging.debug(f'Queued for {client.id}: {message}')
+
+    def get_queue_depths(self) -> Dict[UUID, int]:
+        """Returns the number of frames waiting to be sent to each connected client."""
+        return {client.id: client.queue_depth for client in self._clients.values()}
 
     def _start_loop(self) -> None:
         if self._loop != None:
@@ -120,9 +584,13 @@ class WebsocketService(ServiceBase):
         self._loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self._loop)
         self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.control_workers, thread_name_prefix='WebsocketControl')
         stop = asyncio.get_event_loop().run_in_executor(None, self._stop.wait)
         #self._loop.add_signal_handler(signal.SIGTERM, stop.set_result, None) Linux Only
-        self._loop.run_until_complete(self._listen(stop))
+        try:
+            self._loop.run_until_complete(self._listen(stop))
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
     
     async def _process_request(self, connection: ServerConnection, request: Request):
         request_headers = request.headers
@@ -130,61 +598,177 @@ class WebsocketService(ServiceBase):
         if request_headers.get("Connection", None) == "Upgrade":
             return None
         if path == "/Systems":
-           return connection.respond(HTTPStatus.OK, json.dumps(self._systems, cls=ComplexEncoder))
+            return self._respond_systems(request_headers)
         return connection.respond(HTTPStatus.NOT_FOUND, "Path not found")
 
+    def _get_systems_snapshot(self) -> Tuple[Tuple, str, bytes, bytes]:
+        """Returns the encoded /Systems body, re-encoding only when a system version has changed since the last request."""
+        systems = tuple(self._systems.values())
+        version = (self._registry_version,) + tuple(system.version for system in systems)
+        snapshot = self._systems_snapshot
+        if snapshot is None or snapshot[0] != version:
+            body = json.dumps(systems, cls=ComplexEncoder).encode()
+            etag = f'"{self._etag_prefix}{hashlib.blake2b(repr(version).encode(), digest_size=8).hexdigest()}"'
+            snapshot = self._systems_snapshot = (version, etag, body, None)
+        return snapshot
+
+    def _respond_systems(self, request_headers: Headers) -> Response:
+        version, etag, body, gzip_body = self._get_systems_snapshot()
+        headers = Headers([("Date", email.utils.formatdate(usegmt=True)), ("Connection", "close"), ("ETag", etag), ("Cache-Control", "no-cache")])
+        if_none_match = request_headers.get("If-None-Match", None)
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]):
+            return Response(HTTPStatus.NOT_MODIFIED.value, HTTPStatus.NOT_MODIFIED.phrase, headers, b'')
+        if 'gzip' in request_headers.get("Accept-Encoding", ""):
+            if gzip_body is None:
+                gzip_body = gzip.compress(body)
+                if self._systems_snapshot is not None and self._systems_snapshot[0] == version:
+                    self._systems_snapshot = (version, etag, body, gzip_body)
+            body = gzip_body
+            headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        headers["Content-Length"] = str(len(body))
+        headers["Content-Type"] = "application/json; charset=utf-8"
+        return Response(HTTPStatus.OK.value, HTTPStatus.OK.phrase, headers, body)
+
     async def _listen(self, stop) -> None:
         logging.info(f'Websocket server started on port {self.port}')
-        async with serve(self.behaviour, self.host, self.port, process_request = self._process_request, logger=self.quiet_logger):
+        async with serve(self.behaviour, self.host, self.port, process_request = self._process_request, select_subprotocol=self._select_subprotocol, logger=self.quiet_logger):
             await stop
         logging.info(f'Websocket on port {self.port} stopped')
 
+    def _select_subprotocol(self, connection: ServerConnection, subprotocols: List[str]) -> str:
+        """Picks the preferred wire format offered by the client, continuing without a subprotocol (JSON) if none match."""
+        return next((subprotocol for subprotocol in SUBPROTOCOLS if subprotocol in subprotocols), None)
+
     async def intravision_control_behaviour(self, websocket: ServerConnection) -> None:
         logging.info(f'{websocket.id} Connected from {websocket.remote_address}')
-        async for message in websocket:
-            logging.debug(f'Received from {websocket.id}: {message}')
-            message: WebsocketMessage = json.loads(message, object_hook=WebsocketMessageEncoder.deserialize_websocket_message)
-            system = next((system for system in self._systems if system.id == message.SystemID), None)
-            if system is None:
-                logging.error(f'System does not exist: {message.SystemID}')
-            else:
-                match message.Event:
-                    case "Initialise":
-                        client = WebsocketClient(websocket, system.id)
-                        self._clients.append(client)
-                        await self._send_event(client, WebsocketMessage("Initialisation", system, system.id))
-                        logging.debug(f'Client {websocket.id} registered to System {system.id}')
-                    case _:
-                        logging.error(f'Websocket failed to get event: {message.Event}')
-
-
-
-            """
-                switch (message?.Event)
-                {
-                    case "Initialise":
-                        InitialiseClient(system, e.Client);
-                        break;
-                    case "SetPower":
-                        var powerMessage = (WebsocketBoolMessage)message;
-                        SetSystemPower(system, powerMessage.Data);
-                        break;
-                    case "ControlDevice":
-                        var deviceControlMessage = (WebsocketControlMessage)message;
-                        ControlDevice(system, deviceControlMessage.Data);
-                        break;
-                    case "ControlService":
-                        var serviceControlMessage = (WebsocketControlMessage)message;
-                        ControlService(system, serviceControlMessage.Data);
-                        break;
-                    case "Error":
-                        Log.Logger.Error("Failed to parse {data}", data);
-                        break;
-                }
-            }"""
+        client = WebsocketClient(websocket, self.client_high_water_mark, self.slow_consumer_policy)
+        self._clients[client.id] = client
+        client.start()
+        try:
+            async for message in websocket:
+                logging.debug(f'Received from {websocket.id}: {message}')
+                try:
+                    message: WebsocketMessage = WebsocketMessageEncoder.decode(message, self._handlers.keys())
+                except MessageDecodeError as ex:
+                    logging.error(f'Websocket failed to decode message from {websocket.id}: {ex}')
+                    if ex.message is not None:
+                        self._reply(client, ex.message, 'Error', str(ex))
+                    continue
+                handler = self._handlers[message.Event]
+                system = client.system
+                if system is None or system.id != message.SystemID:
+                    system = self._systems.get(message.SystemID)
+                if system is None:
+                    logging.error(f'System does not exist: {message.SystemID}')
+                    self._reply(client, message, 'Error', f'System does not exist: {message.SystemID}')
+                    continue
+                try:
+                    await handler(client, system, message)
+                except Exception as ex:
+                    logging.exception(f'{message.Event} from {websocket.id} failed')
+                    self._reply(client, message, 'Error', str(ex))
+                else:
+                    self._reply(client, message, 'Ack', None)
+        except ConnectionClosed as ex:
+            logging.info(f'{websocket.id} Connection closed: {ex}')
+        finally:
+            self._remove_client(client)
+        logging.info(f'{websocket.id} Disconnected')
 
+    def _reply(self, client: WebsocketClient, message: WebsocketMessage, event: str, data: any) -> None:
+        """Answers a message that carried a CorrelationID. Messages without one get no reply."""
+        if message.CorrelationID is None:
+            return
+        reply = WebsocketMessage(event, data, message.SystemID, message.CorrelationID)
+        client.enqueue(encode_message(reply, client.binary), not client.binary)
 
-        logging.info(f'{websocket.id} Disconnected')
+    async def _on_initialise(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        """Registers the client and sends it the whole system, or only the updates it missed if it
+        presents the Sequence of the last update it received and those updates are still held."""
+        self._initialise_client(client, system)
+        history = self._histories[system.id]
+        sequence = message.Data.get('Sequence') if isinstance(message.Data, dict) else None
+        missed = history.since(sequence) if isinstance(sequence, int) else None
+        if missed is None:
+            self._send_event(client, WebsocketMessage("Initialisation", system, system.id, Sequence=history.sequence))
+            logging.debug(f'Client {client.id} registered to System {system.id}')
+            return
+        for _, update, frames, subject in missed:
+            if subject is not None and client.subscriptions is not None and not client.subscriptions.accepts(subject):
+                continue
+            client.enqueue(self._get_frame(update, frames, client.binary), not client.binary)
+        logging.debug(f'Client {client.id} resumed System {system.id} from {sequence}, {len(missed)} updates replayed')
+
+    async def _on_set_power(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        if not isinstance(message.Data, bool):
+            raise ValueError(f'SetPower expects a boolean, received {message.Data!r}')
+        await self._run_control(system.set_power, message.Data)
+
+    async def _on_control_device(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        device = self._get_entity(self._devices, self._device_systems, system, message.Data)
+        await self._run_control(device.control, message.Data['Property'], message.Data.get('Value'))
+
+    async def _on_control_service(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        service = self._get_entity(self._services, self._service_systems, system, message.Data)
+        await self._run_control(service.control, message.Data['Property'], message.Data.get('Value'))
+
+    async def _on_subscribe(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        """Narrows the client to the Devices, Services and Properties listed, adding to any earlier subscriptions."""
+        subscriptions = client.subscriptions if client.subscriptions is not None else SubscriptionFilter()
+        subscriptions.subscribe(message.Data)
+        client.subscriptions = subscriptions
+
+    async def _on_unsubscribe(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        """Removes the listed Devices, Services and Properties from the client's subscriptions.
+        Without any Data every subscription is dropped and the client receives all updates again."""
+        if message.Data is None:
+            client.subscriptions = None
+        elif client.subscriptions is not None:
+            client.subscriptions.unsubscribe(message.Data)
+
+    async def _on_error(self, client: WebsocketClient, system: System, message: WebsocketMessage) -> None:
+        logging.error(f'Client {client.id} reported an error: {message.Data}')
+
+    def _get_entity(self, entities: Dict, entity_systems: Dict[str, frozenset[System]], system: System, data: Dict):
+        """Finds the device or service addressed by a control message, checking it belongs to the message's system."""
+        entity_id = data.get('Id') if isinstance(data, dict) else None
+        entity = entities.get(entity_id)
+        if entity is None or system not in entity_systems.get(entity_id, ()):
+            raise ValueError(f'{entity_id} is not part of System {system.id}')
+        return entity
+
+    async def _run_control(self, function: Callable, *args) -> None:
+        """Runs a control call on the bounded control executor so a slow driver never blocks the websocket loop."""
+        await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _initialise_client(self, client: WebsocketClient, system: System) -> None:
+        """Registers a client against a system, moving it if it was previously initialised against another."""
+        if client.closing:
+            return
+        if client.system is not None and client.system is not system:
+            clients = self._system_clients.get(client.system_id)
+            if clients is not None:
+                clients.discard(client)
+        client.system = system
+        client.initialised_at = datetime.now()
+        self._system_clients.setdefault(system.id, set()).add(client)
+
+    def _remove_client(self, client: WebsocketClient) -> None:
+        client.closing = True
+        client.stop()
+        self._clients.pop(client.id, None)
+        self._detach_client(client)
+
+    def _detach_client(self, client: WebsocketClient) -> None:
+        """Stops a client receiving updates from its system, leaving it connected until its receive loop ends."""
+        clients = self._system_clients.get(client.system_id)
+        if clients is not None:
+            clients.discard(client)
+
+    def get_clients(self) -> List[WebsocketClient]:
+        """Returns the clients currently connected to the server."""
+        return list(self._clients.values())
         
     async def echo_behaviour(self, websocket: ServerConnection) -> None:
         """Default echo websocket behaviour for testing."""